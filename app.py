@@ -1,8 +1,14 @@
 import os
 import sys
 import json
-import requests
-from typing import List, Optional, Dict, Any
+import time
+import heapq
+import itertools
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Optional, Dict, Any, Tuple, Callable, NamedTuple
 from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException, Body
 from fastapi.middleware.cors import CORSMiddleware
@@ -10,7 +16,7 @@ from fastapi.staticfiles import StaticFiles
 from fastapi.responses import FileResponse
 from pydantic import BaseModel, Field
 from qdrant_client import QdrantClient
-import google.generativeai as genai
+import numpy as np
 import random
 # ... other imports
 from qdrant_client.http import models as qdrant_models # Add this line
@@ -25,17 +31,112 @@ QDRANT_API_KEY = "eyJhbGciOiJIUzI1NiIsInR5cCI6IkpXVCJ9.eyJhY2Nlc3MiOiJtIn0.-Ipip
 
 QDRANT_COLLECTION_NAME = "fashion_clip_recommender"
 GEMINI_EMBEDDING_MODEL = "models/text-embedding-004"
+GEMINI_GENERATION_MODEL = "gemini-1.5-flash"
 EMBEDDING_DIMENSION = 768
+EMBEDDING_CACHE_SIZE = 2048
+
+# JSON prompts for the same model arriving within this window are sent to
+# Gemini as a single structured-output request.
+LLM_BATCH_WINDOW_SECONDS = 0.05
+LLM_MAX_BATCH_SIZE = 8
+LLM_DISPATCH_WORKERS = 4
+# Upper bound on how long a caller waits for its JSON result before falling back
+LLM_RESULT_TIMEOUT_SECONDS = 60.0
+# Only prompts of the same kind are batched together; each result must carry
+# these keys or its prompt is re-sent on its own.
+LLM_JSON_REQUIRED_KEYS = {
+    "user_profile": ("style_preference", "color_preference", "occasion_focus", "personality"),
+    "choice_approval": ("affinity_score", "approval", "message"),
+}
+
+# Client-side budget for the upstream Gemini quota. Set these at or below the
+# project's real limits (defaults are the free tier) so requests queue here
+# instead of failing upstream. The token budget is shared by all models.
+GEMINI_REQUESTS_PER_MINUTE = {
+    GEMINI_EMBEDDING_MODEL: float(os.getenv("GEMINI_EMBEDDING_REQUESTS_PER_MINUTE", "1500")),
+    GEMINI_GENERATION_MODEL: float(os.getenv("GEMINI_GENERATION_REQUESTS_PER_MINUTE", "15")),
+}
+GEMINI_TOKENS_PER_MINUTE = float(os.getenv("GEMINI_TOKENS_PER_MINUTE", "1000000"))
+GEMINI_GENERATION_OUTPUT_TOKENS = 512
+# Lower value = admitted first; cheap embeddings go ahead of long generations
+PRIORITY_EMBEDDING = 0
+PRIORITY_GENERATION = 1
+ADMISSION_MAX_WAIT_SECONDS = {
+    PRIORITY_EMBEDDING: 5.0,
+    PRIORITY_GENERATION: 2.0,
+}
+# Back-off applied when Gemini itself answers 429 despite the local budget
+GEMINI_QUOTA_RETRY_AFTER_SECONDS = 10.0
+
+def env_list(name: str, default: List[str]) -> List[str]:
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+# Warm-up runs in the background right after startup; /ready answers 503
+# until it finishes so the first routed request doesn't pay for SDK setup,
+# TLS handshakes and cold caches.
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "1") != "0"
+CULTURE_FALLBACK_QUERY = "culturally inspired fusion fashion clothing"
+# Degraded paths search with these, so they are always warmed
+FALLBACK_QUERIES = [
+    "versatile casual fashion items",
+    "versatile fashion clothing",
+    "unique alternative fashion styles",
+    CULTURE_FALLBACK_QUERY,
+]
+WARMUP_QUERIES = env_list("WARMUP_QUERIES", FALLBACK_QUERIES)
+WARMUP_COLORS = env_list("WARMUP_COLORS", ["black", "white", "red", "blue", "green", "beige"])
+CATALOG_PRELOAD_BATCH_SIZE = 256
+
+# Catalog sync pulls points whose payload timestamp (unix seconds) is newer
+# than the last seen watermark. Ingest must stamp this field on every upsert,
+# and it should carry a float payload index so the range filter stays cheap.
+CATALOG_UPDATED_AT_FIELD = "updated_at"
+CATALOG_SYNC_INTERVAL_SECONDS = float(os.getenv("CATALOG_SYNC_INTERVAL_SECONDS", "60"))
+SEARCH_CACHE_SIZE = 512
+# Deltas larger than this clear the search cache instead of checking every
+# entry against every changed point
+SEARCH_CACHE_MAX_SELECTIVE_INVALIDATION = 64
+
+# Per-user sessions keep the generated profile, its embedding and recently
+# shown items so returning users skip profile generation.
+SESSION_TTL_SECONDS = 3600
+SESSION_MAX_USERS = 10_000
+SESSION_SEEN_ITEMS = 200
+SESSION_PROFILE_WEIGHT = 0.3
+
+_genai_module = None
+
+def get_genai():
+    # google.generativeai is slow to import; defer it until Gemini is first needed
+    global _genai_module
+    if _genai_module is None:
+        import google.generativeai as genai
+        _genai_module = genai
+    return _genai_module
+
+def color_query(color: str) -> str:
+    return f"{color} colored clothing fashion"
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     print("Starting Qloo Fashion AI API...")
+    started_at = time.perf_counter()
     if not client_manager.initialize_clients():
         print("Failed to initialize clients")
         sys.exit(1)
+    client_manager.startup_timings["initialize_clients"] = round(time.perf_counter() - started_at, 3)
     print("All clients initialized successfully")
+    # uvicorn only accepts connections once this function yields, so warm-up
+    # runs after that for /ready to be able to report it
+    threading.Thread(target=client_manager.complete_startup, args=(started_at,), name="warm-up", daemon=True).start()
     yield
     print("Shutting down Qloo Fashion AI API...")
+    client_manager.shutting_down = True
+    client_manager.catalog_sync.stop()
+    client_manager.llm.shutdown()
 
 app = FastAPI(
     title="Qloo Fashion AI API",
@@ -65,10 +166,638 @@ app.add_middleware(
 
 app.mount("/images", StaticFiles(directory="data/image"), name="images")
 
+class UpstreamBudgetExceeded(Exception):
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+def is_upstream_quota_error(error: Exception) -> bool:
+    from google.api_core import exceptions as google_exceptions
+    return isinstance(error, google_exceptions.ResourceExhausted)
+
+def estimate_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+class TokenBucket:
+    def __init__(self, capacity: float, refill_per_second: float):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.available = capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updated_at) * self.refill_per_second)
+        self.updated_at = now
+
+    def seconds_until(self, amount: float) -> float:
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.available >= amount:
+            return 0.0
+        return (amount - self.available) / self.refill_per_second
+
+    def consume(self, amount: float):
+        self._refill()
+        self.available -= min(amount, self.capacity)
+
+class AdmissionController:
+    # Every Gemini call waits here until its model's request bucket and the
+    # shared token bucket have room. Waiters are served in (priority, arrival)
+    # order, but a waiter blocked only by its own model's request limit does
+    # not hold up callers for other models.
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.request_buckets = {
+            model: TokenBucket(limit, limit / 60.0) for model, limit in GEMINI_REQUESTS_PER_MINUTE.items()
+        }
+        self.token_bucket = TokenBucket(GEMINI_TOKENS_PER_MINUTE, GEMINI_TOKENS_PER_MINUTE / 60.0)
+        self.waiting: List[Tuple[int, int, str, int]] = []
+        self.sequence = itertools.count()
+        self.stats = {"admitted": 0, "rejected": 0, "upstream_quota_errors": 0}
+
+    def _seconds_until_admissible(self, model: str, tokens: int) -> float:
+        return max(self.request_buckets[model].seconds_until(1), self.token_bucket.seconds_until(tokens))
+
+    def _is_next(self, ticket: Tuple[int, int, str, int]) -> bool:
+        for other in sorted(self.waiting):
+            if other == ticket:
+                return True
+            _, _, model, _ = other
+            if self.request_buckets[model].seconds_until(1) == 0:
+                return False
+        return True
+
+    def acquire(self, model: str, priority: int, tokens: int):
+        deadline = time.monotonic() + ADMISSION_MAX_WAIT_SECONDS[priority]
+        with self.condition:
+            ticket = (priority, next(self.sequence), model, tokens)
+            heapq.heappush(self.waiting, ticket)
+            try:
+                while True:
+                    wait = self._seconds_until_admissible(model, tokens)
+                    if wait == 0 and self._is_next(ticket):
+                        self.request_buckets[model].consume(1)
+                        self.token_bucket.consume(tokens)
+                        self.stats["admitted"] += 1
+                        return
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or wait > remaining:
+                        self.stats["rejected"] += 1
+                        raise UpstreamBudgetExceeded(f"Gemini budget exhausted for {model}, retry in {wait:.1f}s", wait)
+                    self.condition.wait(timeout=min(wait, remaining) if wait > 0 else remaining)
+            finally:
+                self.waiting.remove(ticket)
+                heapq.heapify(self.waiting)
+                self.condition.notify_all()
+
+    def report_quota_exceeded(self, model: str) -> UpstreamBudgetExceeded:
+        # Gemini rejected a call we admitted: drain the model's bucket so
+        # queued callers back off instead of hitting the same 429
+        with self.condition:
+            bucket = self.request_buckets[model]
+            bucket._refill()
+            bucket.available = min(bucket.available, -GEMINI_QUOTA_RETRY_AFTER_SECONDS * bucket.refill_per_second)
+            self.stats["upstream_quota_errors"] += 1
+        return UpstreamBudgetExceeded(f"Gemini quota exceeded upstream for {model}", GEMINI_QUOTA_RETRY_AFTER_SECONDS)
+
+    def snapshot(self) -> dict:
+        with self.condition:
+            for bucket in list(self.request_buckets.values()) + [self.token_bucket]:
+                bucket._refill()
+            queue_depth: Dict[str, int] = {model: 0 for model in self.request_buckets}
+            for _, _, model, _ in self.waiting:
+                queue_depth[model] += 1
+            return {
+                "queue_depth": queue_depth,
+                "requests_available": {
+                    model: round(bucket.available, 2) for model, bucket in self.request_buckets.items()
+                },
+                "tokens_available": round(self.token_bucket.available),
+                **self.stats
+            }
+
+def payload_matches_filters(payload: dict, filters: Optional[Dict[str, Any]]) -> bool:
+    # Mirrors qdrant MatchValue: array fields match when any element equals the value
+    for key, value in (filters or {}).items():
+        if not value:
+            continue
+        field = payload.get(key)
+        if field != value and not (isinstance(field, list) and value in field):
+            return False
+    return True
+
+def point_vector(point) -> Optional[np.ndarray]:
+    vector = getattr(point, "vector", None)
+    if isinstance(vector, dict):
+        vector = next(iter(vector.values()), None)
+    return None if vector is None else np.asarray(vector, dtype=np.float32)
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+def cosine_similarity(a: np.ndarray, b: np.ndarray) -> float:
+    size = min(len(a), len(b))
+    norm = float(np.linalg.norm(a[:size]) * np.linalg.norm(b[:size]))
+    return float(np.dot(a[:size], b[:size])) / norm if norm else 0.0
+
+class CatalogHit(NamedTuple):
+    id: str
+    payload: dict
+    score: float
+
+class CatalogVectorIndex:
+    # One contiguous float32 matrix of L2-normalized rows, so a single
+    # matrix-vector product gives the collection's cosine scores. Storage
+    # grows by doubling so sync can append in place.
+    def __init__(self):
+        self.ids: List[str] = []
+        self.rows: Dict[str, int] = {}
+        self.vectors = np.zeros((0, 0), dtype=np.float32)
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def nbytes(self) -> int:
+        return self.vectors.nbytes
+
+    def build(self, vectors: Dict[str, np.ndarray]):
+        ids = list(vectors)
+        matrix = normalize_rows(np.stack([vectors[point_id] for point_id in ids]).astype(np.float32)) if ids \
+            else np.zeros((0, 0), dtype=np.float32)
+        with self.lock:
+            self.ids = ids
+            self.rows = {point_id: row for row, point_id in enumerate(ids)}
+            self.vectors = matrix
+
+    def _grow(self, dimension: int):
+        capacity = max(16, 2 * self.vectors.shape[0])
+        vectors = np.zeros((capacity, dimension), dtype=np.float32)
+        count = len(self.ids)
+        if count:
+            vectors[:count] = self.vectors[:count]
+        self.vectors = vectors
+
+    def upsert(self, point_id: str, vector: np.ndarray):
+        row_vector = normalize_rows(np.asarray(vector, dtype=np.float32)[None, :])[0]
+        with self.lock:
+            row = self.rows.get(point_id)
+            if row is None:
+                if len(self.ids) >= self.vectors.shape[0]:
+                    self._grow(row_vector.shape[0])
+                row = len(self.ids)
+                self.ids.append(point_id)
+                self.rows[point_id] = row
+            self.vectors[row] = row_vector
+
+    def search(self, query_vector: np.ndarray, limit: int, include: Optional[Callable[[str], bool]] = None) -> List[Tuple[str, float]]:
+        with self.lock:
+            count = len(self.ids)
+            if count == 0 or limit <= 0:
+                return []
+            ids = self.ids[:count]
+            query = normalize_rows(np.asarray(query_vector, dtype=np.float32)[:self.vectors.shape[1]][None, :])[0]
+            scores = self.vectors[:count] @ query
+        if include is not None:
+            scores[~np.fromiter((include(point_id) for point_id in ids), dtype=bool, count=count)] = -np.inf
+        top = min(count, limit)
+        candidates = np.argpartition(-scores, top - 1)[:top]
+        candidates = candidates[np.isfinite(scores[candidates])]
+        candidates = candidates[np.argsort(-scores[candidates])]
+        return [(ids[row], float(scores[row])) for row in candidates]
+
+class SearchResultCache:
+    def __init__(self):
+        self.entries: "OrderedDict[Tuple[str, str, int], dict]" = OrderedDict()
+        self.lock = threading.Lock()
+        # Bumped under the lock by every invalidation; put() drops results
+        # computed before the latest bump
+        self.generation = 0
+        self.stats = {"hits": 0, "misses": 0, "invalidated": 0}
+
+    @staticmethod
+    def make_key(query: str, filters: Optional[Dict[str, Any]], limit: int) -> Tuple[str, str, int]:
+        return (query, json.dumps(filters or {}, sort_keys=True), limit)
+
+    def get(self, key: Tuple[str, str, int]) -> Optional[dict]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry
+
+    def put(self, key: Tuple[str, str, int], query_vector: np.ndarray, filters: Optional[Dict[str, Any]], limit: int, hits: List[Tuple[str, float]], generation: int):
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.entries[key] = {
+                "query_vector": query_vector,
+                "filters": filters,
+                "limit": limit,
+                "hits": hits
+            }
+            self.entries.move_to_end(key)
+            while len(self.entries) > SEARCH_CACHE_SIZE:
+                self.entries.popitem(last=False)
+
+    def _is_affected(self, entry: dict, point_id: str, payload: dict, vector: Optional[np.ndarray]) -> bool:
+        if any(hit_id == point_id for hit_id, _ in entry["hits"]):
+            return True
+        if not payload_matches_filters(payload, entry["filters"]):
+            return False
+        if vector is None or len(entry["hits"]) < entry["limit"]:
+            return True
+        # The point can only enter this result if it outscores the current last hit
+        return cosine_similarity(entry["query_vector"], vector) >= entry["hits"][-1][1]
+
+    def invalidate(self, changed: Dict[str, Tuple[dict, Optional[np.ndarray]]]) -> int:
+        if len(changed) > SEARCH_CACHE_MAX_SELECTIVE_INVALIDATION:
+            return self.clear()
+
+        with self.lock:
+            self.generation += 1
+            entries = list(self.entries.items())
+        # Scoring runs without the lock so cached searches aren't blocked;
+        # entries put meanwhile were computed after the catalog changed
+        stale = [
+            (key, entry) for key, entry in entries
+            if any(self._is_affected(entry, point_id, payload, vector) for point_id, (payload, vector) in changed.items())
+        ]
+        with self.lock:
+            removed = 0
+            for key, entry in stale:
+                if self.entries.get(key) is entry:
+                    del self.entries[key]
+                    removed += 1
+            self.stats["invalidated"] += removed
+            return removed
+
+    def clear(self) -> int:
+        with self.lock:
+            self.generation += 1
+            removed = len(self.entries)
+            self.stats["invalidated"] += removed
+            self.entries.clear()
+            return removed
+
+class CatalogSync:
+    def __init__(self, manager: "ClientManager"):
+        self.manager = manager
+        self.watermark = 0.0
+        self.generation = 0
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+        self.stats = {"syncs": 0, "points_applied": 0, "full_reloads": 0, "last_sync_at": None, "last_error": None}
+
+    def reset(self, catalog: Dict[str, dict]):
+        self.watermark = max((float(payload.get(CATALOG_UPDATED_AT_FIELD) or 0) for payload in catalog.values()), default=0.0)
+
+    def _pull_changes(self) -> Dict[str, Tuple[dict, Optional[np.ndarray]]]:
+        qdrant_client = self.manager.get_qdrant_client()
+        # gte rather than gt: points written in the same second as the last
+        # watermark would otherwise be missed; unchanged ones are skipped below
+        changed_filter = qdrant_models.Filter(must=[
+            qdrant_models.FieldCondition(key=CATALOG_UPDATED_AT_FIELD, range=qdrant_models.Range(gte=self.watermark))
+        ])
+        changed = {}
+        offset = None
+        while True:
+            points, offset = qdrant_client.scroll(
+                collection_name=QDRANT_COLLECTION_NAME,
+                scroll_filter=changed_filter,
+                limit=CATALOG_PRELOAD_BATCH_SIZE,
+                offset=offset,
+                with_payload=True,
+                with_vectors=True
+            )
+            for point in points:
+                point_id = str(point.id)
+                if self.manager.catalog.get(point_id) != point.payload:
+                    changed[point_id] = (point.payload, point_vector(point))
+            if offset is None:
+                break
+        return changed
+
+    def sync(self) -> dict:
+        with self.lock:
+            try:
+                changed = self._pull_changes()
+                if not self.manager.uses_local_index():
+                    # Cosine scores can't be compared against the cached
+                    # hits; without a vector invalidation stays conservative
+                    changed = {point_id: (payload, None) for point_id, (payload, _) in changed.items()}
+                for point_id, (payload, vector) in changed.items():
+                    if vector is not None:
+                        self.manager.catalog_index.upsert(point_id, vector)
+                    self.manager.catalog[point_id] = payload
+                    self.watermark = max(self.watermark, float(payload.get(CATALOG_UPDATED_AT_FIELD) or 0))
+                invalidated = self.manager.search_cache.invalidate(changed) if changed else 0
+                if changed:
+                    self.generation += 1
+
+                # Deletions don't show up in a timestamp scroll; a count
+                # mismatch is the signal to fall back to a full reload
+                remote_count = self.manager.get_qdrant_client().count(collection_name=QDRANT_COLLECTION_NAME, exact=True).count
+                full_reload = remote_count != len(self.manager.catalog)
+                if full_reload:
+                    self.manager.preload_catalog()
+                    self.manager.search_cache.clear()
+                    self.generation += 1
+                    self.stats["full_reloads"] += 1
+
+                self.stats["syncs"] += 1
+                self.stats["points_applied"] += len(changed)
+                self.stats["last_sync_at"] = time.time()
+                self.stats["last_error"] = None
+                return {
+                    "changed_points": len(changed),
+                    "invalidated_cache_entries": invalidated,
+                    "full_reload": full_reload,
+                    "generation": self.generation,
+                    "watermark": self.watermark
+                }
+            except Exception as e:
+                self.stats["last_error"] = str(e)
+                raise
+
+    def _run(self):
+        while not self.stop_event.wait(CATALOG_SYNC_INTERVAL_SECONDS):
+            try:
+                result = self.sync()
+                if result["changed_points"] or result["full_reload"]:
+                    print(f"Catalog sync applied: {result}")
+            except Exception as e:
+                print(f"Catalog sync failed: {e}")
+
+    def start(self):
+        if self.thread is None and CATALOG_SYNC_INTERVAL_SECONDS > 0:
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self._run, name="catalog-sync", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread = None
+
+    def snapshot(self) -> dict:
+        return {
+            "generation": self.generation,
+            "watermark": self.watermark,
+            "items": len(self.manager.catalog),
+            "indexed_vectors": len(self.manager.catalog_index),
+            "index_bytes": self.manager.catalog_index.nbytes,
+            **self.stats
+        }
+
+class UserSession:
+    def __init__(self, user_id: str, preferences: Optional[str], profile: dict, profile_vector: Optional[np.ndarray]):
+        self.user_id = user_id
+        self.preferences = preferences
+        self.profile = profile
+        self.profile_vector = profile_vector
+        self.seen_items: "OrderedDict[str, None]" = OrderedDict()
+        self.touched_at = time.monotonic()
+
+    def mark_seen(self, item_ids: List[str]):
+        for item_id in item_ids:
+            self.seen_items[item_id] = None
+            self.seen_items.move_to_end(item_id)
+        while len(self.seen_items) > SESSION_SEEN_ITEMS:
+            self.seen_items.popitem(last=False)
+
+class UserSessionStore:
+    def __init__(self):
+        self.sessions: "OrderedDict[str, UserSession]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "expired": 0}
+
+    def get(self, user_id: Optional[str]) -> Optional[UserSession]:
+        if not user_id:
+            return None
+        with self.lock:
+            session = self.sessions.get(user_id)
+            if session is not None and time.monotonic() - session.touched_at > SESSION_TTL_SECONDS:
+                del self.sessions[user_id]
+                self.stats["expired"] += 1
+                session = None
+            if session is None:
+                self.stats["misses"] += 1
+                return None
+            session.touched_at = time.monotonic()
+            self.sessions.move_to_end(user_id)
+            self.stats["hits"] += 1
+            return session
+
+    def put(self, session: UserSession):
+        with self.lock:
+            existing = self.sessions.get(session.user_id)
+            if existing is not None:
+                session.seen_items = existing.seen_items
+            self.sessions[session.user_id] = session
+            self.sessions.move_to_end(session.user_id)
+            while len(self.sessions) > SESSION_MAX_USERS:
+                self.sessions.popitem(last=False)
+
+    def seen_ids(self, user_id: Optional[str]) -> set:
+        with self.lock:
+            session = self.sessions.get(user_id) if user_id else None
+            return set(session.seen_items) if session is not None else set()
+
+    def mark_seen(self, user_id: Optional[str], item_ids: List[str]):
+        with self.lock:
+            session = self.sessions.get(user_id) if user_id else None
+            if session is not None:
+                session.mark_seen(item_ids)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {"active": len(self.sessions), **self.stats}
+
+class LLMGateway:
+    def __init__(self, admission: AdmissionController):
+        self.admission = admission
+        self.models: Dict[Tuple[str, bool], Any] = {}
+        self.models_lock = threading.Lock()
+        self.queues: Dict[Tuple[str, str], "queue.Queue[Tuple[str, Future]]"] = {}
+        self.queues_lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=LLM_DISPATCH_WORKERS, thread_name_prefix="llm-dispatch")
+        self.stats = {
+            "json_prompts": 0,
+            "text_prompts": 0,
+            "upstream_calls": 0,
+            "batched_calls": 0,
+            "batch_fallbacks": 0
+        }
+        self.stats_lock = threading.Lock()
+
+    def _count(self, stat: str):
+        with self.stats_lock:
+            self.stats[stat] += 1
+
+    def get_model(self, model_name: str, json_mode: bool = False):
+        key = (model_name, json_mode)
+        with self.models_lock:
+            if key not in self.models:
+                generation_config = {"response_mime_type": "application/json"} if json_mode else None
+                self.models[key] = get_genai().GenerativeModel(model_name, generation_config=generation_config)
+            return self.models[key]
+
+    def _call(self, model_name: str, prompt: str, json_mode: bool, expected_results: int = 1) -> str:
+        self.admission.acquire(
+            model_name,
+            PRIORITY_GENERATION,
+            estimate_tokens(prompt) + GEMINI_GENERATION_OUTPUT_TOKENS * expected_results
+        )
+        self._count("upstream_calls")
+        try:
+            return self.get_model(model_name, json_mode).generate_content(prompt).text
+        except Exception as e:
+            if is_upstream_quota_error(e):
+                raise self.admission.report_quota_exceeded(model_name) from e
+            raise
+
+    def generate_text(self, prompt: str, model_name: str = GEMINI_GENERATION_MODEL) -> str:
+        self._count("text_prompts")
+        return self._call(model_name, prompt, json_mode=False).strip()
+
+    def generate_json(self, prompt: str, kind: str, model_name: str = GEMINI_GENERATION_MODEL) -> dict:
+        self._count("json_prompts")
+        future: Future = Future()
+        self._get_queue(model_name, kind).put((prompt, future))
+        return future.result(timeout=LLM_RESULT_TIMEOUT_SECONDS)
+
+    @staticmethod
+    def _is_valid_result(kind: str, result: Any) -> bool:
+        return isinstance(result, dict) and all(key in result for key in LLM_JSON_REQUIRED_KEYS[kind])
+
+    def _get_queue(self, model_name: str, kind: str) -> "queue.Queue[Tuple[str, Future]]":
+        key = (model_name, kind)
+        with self.queues_lock:
+            if key not in self.queues:
+                self.queues[key] = queue.Queue()
+                threading.Thread(
+                    target=self._collect_batches,
+                    args=(model_name, kind, self.queues[key]),
+                    name=f"llm-batcher-{model_name}-{kind}",
+                    daemon=True
+                ).start()
+            return self.queues[key]
+
+    def _collect_batches(self, model_name: str, kind: str, pending: "queue.Queue[Tuple[str, Future]]"):
+        while True:
+            batch = [pending.get()]
+            deadline = time.monotonic() + LLM_BATCH_WINDOW_SECONDS
+            while len(batch) < LLM_MAX_BATCH_SIZE:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(pending.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                self.executor.submit(self._dispatch_safely, model_name, kind, batch)
+            except RuntimeError as e:
+                # The executor is shut down; fail the callers instead of leaving them waiting
+                self._fail_unresolved(batch, e)
+
+    @staticmethod
+    def _fail_unresolved(batch: List[Tuple[str, Future]], error: BaseException):
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(error)
+
+    def _dispatch_safely(self, model_name: str, kind: str, batch: List[Tuple[str, Future]]):
+        try:
+            self._dispatch(model_name, kind, batch)
+        except Exception as e:
+            print(f"LLM dispatch failed: {e}")
+            self._fail_unresolved(batch, e)
+        finally:
+            self._fail_unresolved(batch, RuntimeError("LLM dispatch ended without a result"))
+
+    def _dispatch(self, model_name: str, kind: str, batch: List[Tuple[str, Future]]):
+        if len(batch) > 1:
+            try:
+                results = self._generate_batch(model_name, [prompt for prompt, _ in batch])
+            except UpstreamBudgetExceeded as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                return
+            except Exception as e:
+                print(f"Batched LLM call failed, retrying prompts individually: {e}")
+                results = {}
+
+            unresolved = []
+            for index, (prompt, future) in enumerate(batch, start=1):
+                result = results.get(index)
+                if self._is_valid_result(kind, result):
+                    future.set_result(result)
+                else:
+                    unresolved.append((prompt, future))
+            if unresolved:
+                self._count("batch_fallbacks")
+            batch = unresolved
+
+        for prompt, future in batch:
+            try:
+                result = json.loads(self._call(model_name, prompt, json_mode=True))
+                if not self._is_valid_result(kind, result):
+                    raise ValueError(f"{kind} result is missing required keys")
+                future.set_result(result)
+            except Exception as e:
+                future.set_exception(e)
+
+    def _generate_batch(self, model_name: str, prompts: List[str]) -> Dict[int, Any]:
+        # Results are matched back to prompts by their echoed task number,
+        # never by position in the array
+        tasks = "\n\n".join(f"### Task {index}\n{prompt.strip()}" for index, prompt in enumerate(prompts, start=1))
+        batch_prompt = f"""
+        You will receive {len(prompts)} independent tasks. Solve each one separately.
+        Return a JSON array with one element per task, each shaped as
+        {{"task": <task number>, "result": <the JSON result for that task>}}.
+
+        {tasks}
+        """
+        self._count("batched_calls")
+        elements = json.loads(self._call(model_name, batch_prompt, json_mode=True, expected_results=len(prompts)))
+        if not isinstance(elements, list):
+            raise ValueError(f"expected a JSON array, got {type(elements).__name__}")
+        results = {}
+        for element in elements:
+            if isinstance(element, dict) and isinstance(element.get("task"), int) and element["task"] not in results:
+                results[element["task"]] = element.get("result")
+        return results
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
 class ClientManager:
     def __init__(self):
         self.qdrant_client = None
         self.gemini_configured = False
+        self.admission = AdmissionController()
+        self.llm = LLMGateway(self.admission)
+        self.ready = False
+        self.shutting_down = False
+        self.startup_timings: Dict[str, float] = {}
+        self.warmup_errors: List[str] = []
+        self.catalog: Dict[str, dict] = {}
+        self.catalog_index = CatalogVectorIndex()
+        self.vector_distance = None
+        self.search_cache = SearchResultCache()
+        self.sessions = UserSessionStore()
+        self.catalog_sync = CatalogSync(self)
+        self.embedding_cache: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self.embedding_cache_lock = threading.Lock()
         
     def initialize_clients(self):
         try:
@@ -78,7 +807,7 @@ class ClientManager:
             )
             print("Qdrant client initialized successfully")
 
-            genai.configure(api_key=GEMINI_API_KEY)
+            get_genai().configure(api_key=GEMINI_API_KEY)
             self.gemini_configured = True
             print("Gemini client configured successfully")
             
@@ -95,26 +824,144 @@ class ClientManager:
     def is_gemini_configured(self):
         return self.gemini_configured
         
-    def get_embedding(self, text: str) -> List[float]:
+    def get_embedding(self, text: str) -> np.ndarray:
         if not self.is_gemini_configured():
             raise HTTPException(status_code=500, detail="Gemini client not configured")
-            
-        result = genai.embed_content(
-            model=GEMINI_EMBEDDING_MODEL,
-            content=text,
-            task_type="RETRIEVAL_QUERY"
-        )
-        embedding = result['embedding']
-        
-        if len(embedding) > 512:
-            embedding = embedding[:512]
-            
+
+        cached = self.get_cached_embedding(text)
+        if cached is not None:
+            return cached
+
+        try:
+            self.admission.acquire(GEMINI_EMBEDDING_MODEL, PRIORITY_EMBEDDING, estimate_tokens(text))
+            try:
+                result = get_genai().embed_content(
+                    model=GEMINI_EMBEDDING_MODEL,
+                    content=text,
+                    task_type="RETRIEVAL_QUERY"
+                )
+            except Exception as e:
+                if is_upstream_quota_error(e):
+                    raise self.admission.report_quota_exceeded(GEMINI_EMBEDDING_MODEL) from e
+                raise
+        except UpstreamBudgetExceeded as e:
+            raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(max(1, round(e.retry_after)))})
+        # float32 array: ~2KB per vector instead of a list of boxed floats
+        embedding = np.asarray(result['embedding'][:512], dtype=np.float32)
+
+        self.cache_embedding(text, embedding)
         return embedding
 
+    def get_cached_embedding(self, text: str) -> Optional[np.ndarray]:
+        with self.embedding_cache_lock:
+            embedding = self.embedding_cache.get(text)
+            if embedding is not None:
+                self.embedding_cache.move_to_end(text)
+            return embedding
+
+    def cache_embedding(self, text: str, embedding: np.ndarray):
+        with self.embedding_cache_lock:
+            self.embedding_cache[text] = embedding
+            self.embedding_cache.move_to_end(text)
+            while len(self.embedding_cache) > EMBEDDING_CACHE_SIZE:
+                self.embedding_cache.popitem(last=False)
+
+    def embedding_cache_nbytes(self) -> int:
+        with self.embedding_cache_lock:
+            return sum(vector.nbytes for vector in self.embedding_cache.values())
+
+    def record_collection_info(self, collection):
+        vectors = collection.config.params.vectors
+        self.vector_distance = getattr(vectors, "distance", None)
+        if not self.uses_local_index():
+            print(f"Collection distance is {self.vector_distance}, local vector index disabled")
+
+    def uses_local_index(self) -> bool:
+        # Local scores are cosine similarities; any other metric would rank
+        # differently from Qdrant, so those collections are searched remotely
+        return self.vector_distance == qdrant_models.Distance.COSINE
+
+    def preload_catalog(self) -> int:
+        qdrant_client = self.get_qdrant_client()
+        if self.vector_distance is None:
+            self.record_collection_info(qdrant_client.get_collection(QDRANT_COLLECTION_NAME))
+        with_vectors = self.uses_local_index()
+        catalog = {}
+        vectors = {}
+        offset = None
+        while True:
+            points, offset = qdrant_client.scroll(
+                collection_name=QDRANT_COLLECTION_NAME,
+                limit=CATALOG_PRELOAD_BATCH_SIZE,
+                offset=offset,
+                with_payload=True,
+                with_vectors=with_vectors
+            )
+            for point in points:
+                catalog[str(point.id)] = point.payload
+                vector = point_vector(point) if with_vectors else None
+                if vector is not None:
+                    vectors[str(point.id)] = vector
+            if offset is None:
+                break
+        self.catalog_index.build(vectors)
+        self.catalog = catalog
+        self.catalog_sync.reset(catalog)
+        return len(catalog)
+
+    def _timed_warmup_step(self, name: str, step):
+        started_at = time.perf_counter()
+        try:
+            result = step()
+            print(f"Warm-up step '{name}' done: {result}")
+        except Exception as e:
+            self.warmup_errors.append(f"{name}: {e}")
+            print(f"Warm-up step '{name}' failed: {e}")
+        self.startup_timings[name] = round(time.perf_counter() - started_at, 3)
+
+    def complete_startup(self, started_at: float):
+        if WARMUP_ENABLED:
+            self.warm_up()
+        self.startup_timings["total"] = round(time.perf_counter() - started_at, 3)
+        self.ready = True
+        print(f"Startup completed in {self.startup_timings['total']}s: {self.startup_timings}")
+        if not self.shutting_down:
+            self.catalog_sync.start()
+
+    def warm_up(self):
+        # Each step is best-effort: a failed warm-up only costs latency later,
+        # it must never keep the API from starting.
+        def open_connections():
+            collection = self.get_qdrant_client().get_collection(QDRANT_COLLECTION_NAME)
+            self.record_collection_info(collection)
+            return f"qdrant collection status {collection.status}, distance {self.vector_distance}"
+
+        def prepare_generation_models():
+            for json_mode in (False, True):
+                self.llm.get_model(GEMINI_GENERATION_MODEL, json_mode)
+            # A metadata lookup opens the generation channel without using generation quota
+            model_info = get_genai().get_model(f"models/{GEMINI_GENERATION_MODEL}")
+            return f"{model_info.name} ready"
+
+        def embed_hot_queries():
+            texts = list(dict.fromkeys(FALLBACK_QUERIES + WARMUP_QUERIES + [color_query(color) for color in WARMUP_COLORS]))
+            for text in texts:
+                self.get_embedding(text)
+            return f"{len(texts)} embeddings cached"
+
+        def preload_catalog():
+            return f"{self.preload_catalog()} items loaded"
+
+        self._timed_warmup_step("warmup_connections", open_connections)
+        self._timed_warmup_step("warmup_generation_models", prepare_generation_models)
+        self._timed_warmup_step("warmup_embeddings", embed_hot_queries)
+        self._timed_warmup_step("warmup_catalog", preload_catalog)
+
 client_manager = ClientManager()
 
 class UserPreferencesRequest(BaseModel):
-    preferences: str = Field(..., example="I love minimalist style, prefer neutral colors, and like comfortable casual wear")
+    preferences: Optional[str] = Field(None, example="I love minimalist style, prefer neutral colors, and like comfortable casual wear")
+    user_id: Optional[str] = Field(None, example="user_123")
 
 class CultureRequest(BaseModel):
     cultures: List[str] = Field(..., example=["Japanese", "Italian"])
@@ -124,6 +971,7 @@ class SearchRequest(BaseModel):
     query: str = Field(..., example="red summer dress")
     style_preferences: Optional[str] = Field(None, example="I prefer elegant, formal styles")
     filters: Optional[Dict[str, Any]] = Field(None, example={"dominant_color": "red", "clothing_type": "dress"})
+    user_id: Optional[str] = Field(None, example="user_123")
 
 class AntiRecommendationRequest(BaseModel):
     current_item_description: str = Field(..., example="black formal suit")
@@ -132,6 +980,7 @@ class AntiRecommendationRequest(BaseModel):
 class ChoiceApprovalRequest(BaseModel):
     item_description: str = Field(..., example="floral summer dress")
     user_style: Optional[str] = Field(None, example="I love romantic, feminine styles")
+    user_id: Optional[str] = Field(None, example="user_123")
 
 class FashionItem(BaseModel):
     id: str
@@ -150,6 +999,12 @@ class FashionItem(BaseModel):
     remarks: Optional[str]
 
 def generate_user_profile(preferences: Optional[str] = None, context: Optional[str] = None) -> dict:
+    user_profile, _ = generate_user_profile_with_status(preferences, context)
+    return user_profile
+
+def generate_user_profile_with_status(preferences: Optional[str] = None, context: Optional[str] = None) -> Tuple[dict, bool]:
+    # The flag is True when the profile is a canned fallback rather than one
+    # generated for these preferences, so callers know not to persist it
     try:
         if not client_manager.is_gemini_configured():
             return {
@@ -157,7 +1012,7 @@ def generate_user_profile(preferences: Optional[str] = None, context: Optional[s
                 "color_preference": ["neutral", "earth-tones"],
                 "occasion_focus": ["casual", "work"],
                 "personality": "practical-minimalist"
-            }
+            }, True
         
         prompt = f"""
         Based on the following information, create a detailed fashion user profile:
@@ -176,12 +1031,10 @@ def generate_user_profile(preferences: Optional[str] = None, context: Optional[s
         Return only valid JSON, no other text.
         """
         
-        model = genai.GenerativeModel('gemini-pro')
-        response = model.generate_content(prompt)
-        
         try:
-            return json.loads(response.text)
-        except:
+            return client_manager.llm.generate_json(prompt, "user_profile"), False
+        except Exception as e:
+            print(f"Profile JSON generation failed: {e}")
             return {
                 "style_preference": "contemporary",
                 "color_preference": ["versatile", "classic"],
@@ -189,7 +1042,7 @@ def generate_user_profile(preferences: Optional[str] = None, context: Optional[s
                 "personality": "adaptable-style",
                 "age_group": "adult",
                 "lifestyle": "balanced"
-            }
+            }, True
             
     except Exception as e:
         print(f"Profile generation error: {e}")
@@ -198,12 +1051,55 @@ def generate_user_profile(preferences: Optional[str] = None, context: Optional[s
             "color_preference": ["neutral"],
             "occasion_focus": ["casual"],
             "personality": "practical"
-        }
+        }, True
+
+def profile_style_query(user_profile: dict) -> str:
+    style_query = f"{user_profile.get('style_preference', 'contemporary')} "
+    style_query += f"{user_profile.get('personality', 'versatile')} style clothing"
+    
+    if user_profile.get('lifestyle'):
+        style_query += f" for {user_profile.get('lifestyle')} lifestyle"
+    return style_query
+
+def embed_session_profile(user_profile: dict) -> Optional[np.ndarray]:
+    try:
+        return get_gemini_embedding(profile_style_query(user_profile))
+    except HTTPException as e:
+        print(f"Profile embedding skipped: {e.detail}")
+        return None
+
+def get_session_profile(user_id: Optional[str], preferences: Optional[str], context: str) -> Tuple[dict, Optional[UserSession]]:
+    # Reuse the stored profile unless the user sent different preferences
+    session = client_manager.sessions.get(user_id)
+    if session is not None and (preferences is None or preferences == session.preferences):
+        if session.profile_vector is None:
+            # The embedding failed when the session was created; retry it
+            # instead of personalizing without a vector for the whole TTL
+            session.profile_vector = embed_session_profile(session.profile)
+        return session.profile, session
+
+    user_profile, is_fallback = generate_user_profile_with_status(preferences, context)
+    if not user_id or is_fallback:
+        # Never pin a canned fallback profile to the user; the next request
+        # gets another chance at generating a real one
+        return user_profile, None
+
+    session = UserSession(user_id, preferences, user_profile, embed_session_profile(user_profile))
+    client_manager.sessions.put(session)
+    return user_profile, session
+
+def personalize_query_vector(query_vector: np.ndarray, session: Optional[UserSession]) -> np.ndarray:
+    if session is None or session.profile_vector is None:
+        return query_vector
+    blended = normalize_rows(query_vector[None, :])[0] + SESSION_PROFILE_WEIGHT * normalize_rows(session.profile_vector[None, :])[0]
+    return normalize_rows(blended[None, :])[0]
 
 def qdrant_payload_to_fashion_item(point) -> FashionItem:
-    payload = point.payload
+    return payload_to_fashion_item(point.id, point.payload)
+
+def payload_to_fashion_item(point_id, payload: dict) -> FashionItem:
     return FashionItem(
-        id=str(point.id),
+        id=str(point_id),
         original_id=payload.get('original_id', ''),
         image_url=f"/images/{payload.get('original_id', '')}.jpg",
         clothing_type=payload.get('clothing_type', ''),
@@ -224,7 +1120,7 @@ class CulturalFusionRequest(BaseModel):
     cultures: List[str]
 
 @app.post("/cultural-fusion")
-async def get_cultural_fusion_recommendations(request: CulturalFusionRequest):
+def get_cultural_fusion_recommendations(request: CulturalFusionRequest):
     try:
         # Generate a cultural fusion query using Gemini
         culture_prompt = f"""
@@ -237,19 +1133,23 @@ async def get_cultural_fusion_recommendations(request: CulturalFusionRequest):
         Keep it concise but descriptive.
         """
         
-        model = genai.GenerativeModel('gemini-1.5-flash')
-        fusion_description = model.generate_content(culture_prompt).text
-        
-        # Use the generated description to find relevant fashion items
-        query_vector = get_gemini_embedding(fusion_description)
-        search_results = client_manager.qdrant_client.search(
-            collection_name=QDRANT_COLLECTION_NAME,
-            query_vector=query_vector,
-            limit=9
-        )
+        try:
+            fusion_description = client_manager.llm.generate_text(culture_prompt)
+            fusion_query = fusion_description
+        except UpstreamBudgetExceeded as e:
+            print(f"Cultural fusion generation skipped: {e}")
+            fusion_description = f"Fashion blending {' and '.join(request.cultures)} cultural elements in colors, patterns and silhouettes"
+            fusion_query = CULTURE_FALLBACK_QUERY
+        
+        # Use the generated description to find relevant fashion items,
+        # steered by the user's stored profile when we have a session
+        session = client_manager.sessions.get(request.user_id)
+        query_vector = personalize_query_vector(get_gemini_embedding(fusion_query), session)
+        search_results = search_catalog(query_vector, limit=9, exclude_ids=client_manager.sessions.seen_ids(request.user_id))
         
         # Convert the results to fashion items
         items = [qdrant_payload_to_fashion_item(point) for point in search_results]
+        client_manager.sessions.mark_seen(request.user_id, [item.id for item in items])
         
         # Generate a cultural blend name
         blend_name = ' × '.join(culture.capitalize() for culture in request.cultures)
@@ -259,61 +1159,89 @@ async def get_cultural_fusion_recommendations(request: CulturalFusionRequest):
             "cultural_blend": blend_name,
             "description": fusion_description
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-def get_gemini_embedding(text: str) -> List[float]:
+def get_gemini_embedding(text: str) -> np.ndarray:
     try:
-        if not client_manager.is_gemini_configured():
-            raise HTTPException(status_code=500, detail="Gemini client not configured")
-            
-        result = genai.embed_content(
-            model=GEMINI_EMBEDDING_MODEL,
-            content=text,
-            task_type="RETRIEVAL_QUERY"
-        )
-        embedding = result['embedding']
-        
-        if len(embedding) > 512:
-            embedding = embedding[:512]
-            
-        return embedding
+        return client_manager.get_embedding(text)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Gemini embedding failed: {e}")
 
-def search_fashion_items_in_qdrant(query: str, limit: int = 10, user_profile: Optional[dict] = None, filters: Optional[Dict[str, Any]] = None) -> List[FashionItem]:
+def search_catalog(query_vector: np.ndarray, limit: int, filters: Optional[Dict[str, Any]] = None, exclude_ids: Optional[Any] = None) -> List[CatalogHit]:
+    hits = _search_catalog(query_vector, limit, filters, exclude_ids)
+    if not hits and exclude_ids:
+        # The user has already seen every match; repeating beats an empty page
+        hits = _search_catalog(query_vector, limit, filters)
+    return hits
+
+def _search_catalog(query_vector: np.ndarray, limit: int, filters: Optional[Dict[str, Any]] = None, exclude_ids: Optional[Any] = None) -> List[CatalogHit]:
+    catalog = client_manager.catalog
+    index = client_manager.catalog_index
+    if len(index) and len(index) == len(catalog):
+        include = None
+        if filters or exclude_ids:
+            include = lambda point_id: point_id not in (exclude_ids or ()) and payload_matches_filters(catalog.get(point_id, {}), filters)
+        return [CatalogHit(point_id, catalog.get(point_id, {}), score) for point_id, score in index.search(query_vector, limit, include)]
+
+    # Build the metadata filter
+    qdrant_filter = None
+    if filters:
+        conditions = []
+        for key, value in filters.items():
+            if value:  # Only add filter if a value is provided
+                conditions.append(
+                    qdrant_models.FieldCondition(
+                        key=key,
+                        match=qdrant_models.MatchValue(value=value)
+                    )
+                )
+        if conditions:
+            qdrant_filter = qdrant_models.Filter(must=conditions)
+    if exclude_ids:
+        excluded = [int(point_id) if point_id.isdigit() else point_id for point_id in exclude_ids]
+        qdrant_filter = qdrant_models.Filter(
+            must=qdrant_filter.must if qdrant_filter else None,
+            must_not=[qdrant_models.HasIdCondition(has_id=excluded)]
+        )
+
+    qdrant_client = client_manager.get_qdrant_client()
+    hits = qdrant_client.search(
+        collection_name=QDRANT_COLLECTION_NAME,
+        query_vector=query_vector.tolist(),
+        query_filter=qdrant_filter,  # Apply the filter here
+        limit=limit,
+        with_payload=True
+    )
+    return [CatalogHit(str(hit.id), hit.payload, hit.score) for hit in hits]
+
+def search_fashion_items_in_qdrant(query: str, limit: int = 10, user_profile: Optional[dict] = None, filters: Optional[Dict[str, Any]] = None, session: Optional[UserSession] = None) -> List[FashionItem]:
     try:
+        if session is not None and session.profile_vector is not None:
+            # Personalize with the stored profile vector: the raw query embedding
+            # stays cacheable and no profile text has to be re-embedded
+            query_vector = personalize_query_vector(get_gemini_embedding(query), session)
+            hits = search_catalog(query_vector, limit, filters, exclude_ids=client_manager.sessions.seen_ids(session.user_id))
+            return [qdrant_payload_to_fashion_item(hit) for hit in hits]
+
         enhanced_query = query
         if user_profile:
             style_context = f" {user_profile.get('style_preference', '')} style"
             color_context = f" in {', '.join(user_profile.get('color_preference', []))} colors"
             enhanced_query = f"{query}{style_context}{color_context}"
         
-        query_vector = get_gemini_embedding(enhanced_query)
-        
-        # Build the metadata filter
-        qdrant_filter = None
-        if filters:
-            conditions = []
-            for key, value in filters.items():
-                if value:  # Only add filter if a value is provided
-                    conditions.append(
-                        qdrant_models.FieldCondition(
-                            key=key,
-                            match=qdrant_models.MatchValue(value=value)
-                        )
-                    )
-            if conditions:
-                qdrant_filter = qdrant_models.Filter(must=conditions)
+        cache_key = SearchResultCache.make_key(enhanced_query, filters, limit)
+        cached = client_manager.search_cache.get(cache_key)
+        if cached is not None and all(hit_id in client_manager.catalog for hit_id, _ in cached["hits"]):
+            return [payload_to_fashion_item(hit_id, client_manager.catalog[hit_id]) for hit_id, _ in cached["hits"]]
 
-        qdrant_client = client_manager.get_qdrant_client()
-        hits = qdrant_client.search(
-            collection_name=QDRANT_COLLECTION_NAME,
-            query_vector=query_vector,
-            query_filter=qdrant_filter,  # Apply the filter here
-            limit=limit,
-            with_payload=True
-        )
+        generation = client_manager.search_cache.generation
+        query_vector = get_gemini_embedding(enhanced_query)
+        hits = search_catalog(query_vector, limit, filters)
         
         fashion_items = []
         for hit in hits:
@@ -323,14 +1251,24 @@ def search_fashion_items_in_qdrant(query: str, limit: int = 10, user_profile: Op
             except Exception as e:
                 print(f"Error converting item: {e}")
                 continue
+
+        # Only cache results that can be rebuilt from the local catalog; put()
+        # discards them if a sync invalidated the cache while we searched
+        if client_manager.catalog and all(hit.id in client_manager.catalog for hit in hits):
+            client_manager.search_cache.put(cache_key, query_vector, filters, limit, [(hit.id, hit.score) for hit in hits], generation)
                 
         return fashion_items
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Fashion search failed: {e}")
 
 def get_qdrant_item_details(item_ids: List[int]) -> List[dict]:
     try:
+        if client_manager.catalog and all(str(item_id) in client_manager.catalog for item_id in item_ids):
+            return [client_manager.catalog[str(item_id)] for item_id in item_ids]
+
         qdrant_client = client_manager.get_qdrant_client()
         records = qdrant_client.retrieve(
             collection_name=QDRANT_COLLECTION_NAME,
@@ -343,8 +1281,6 @@ def get_qdrant_item_details(item_ids: List[int]) -> List[dict]:
 
 def get_anti_recommendations(current_item_description: str, style_preferences: Optional[str] = None):
     try:
-        user_profile = generate_user_profile(style_preferences, f"Finding opposite styles to: {current_item_description}")
-        
         prompt = f"""
         Current item: {current_item_description}
         User style: {style_preferences or 'Not specified'}
@@ -354,12 +1290,12 @@ def get_anti_recommendations(current_item_description: str, style_preferences: O
         Return only the search query, no other text.
         """
         
+        opposite_query = "unique alternative fashion styles"
         if client_manager.is_gemini_configured():
-            model = genai.GenerativeModel('gemini-1.5-flash') 
-            response = model.generate_content(prompt)
-            opposite_query = response.text.strip()
-        else:
-            opposite_query = "unique alternative fashion styles"
+            try:
+                opposite_query = client_manager.llm.generate_text(prompt)
+            except UpstreamBudgetExceeded as e:
+                print(f"Anti-recommendation query generation skipped: {e}")
         
         items = search_fashion_items_in_qdrant(opposite_query, limit=8)
         
@@ -371,6 +1307,8 @@ def get_anti_recommendations(current_item_description: str, style_preferences: O
             "search_context": opposite_query
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=502, detail=f"Anti-recommendation generation failed: {e}")
 
@@ -434,6 +1372,8 @@ def get_actionable_suggestions(style_preferences: Optional[str] = None):
             "items": [item.dict() for item in unique_items[:8]]
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=502, detail=f"Suggestion generation failed: {e}")
 
@@ -454,9 +1394,14 @@ def get_mixed_culture_recommendations(cultures: List[str], preferences: Optional
             Return only the search query, no other text.
             """
             
-            model = genai.GenerativeModel('gemini-pro')
-            response = model.generate_content(prompt)
-            enhanced_query = response.text.strip()
+            try:
+                enhanced_query = client_manager.llm.generate_text(prompt)
+            except UpstreamBudgetExceeded as e:
+                print(f"Mixed culture query generation skipped: {e}")
+                # Out of budget: search with the warmed query, without the
+                # profile suffix, so no fresh embedding call is needed
+                enhanced_query = CULTURE_FALLBACK_QUERY
+                user_profile = None
         else:
             enhanced_query = culture_query
         
@@ -470,21 +1415,23 @@ def get_mixed_culture_recommendations(cultures: List[str], preferences: Optional
             "items": [item.dict() for item in items]
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Mixed culture recommendation failed: {e}")
 
 
-def find_fashion_twin(style_preferences: Optional[str] = None):
+def find_fashion_twin(style_preferences: Optional[str] = None, user_id: Optional[str] = None):
     try:
-        user_profile = generate_user_profile(style_preferences, "Finding similar style items")
-        
-        style_query = f"{user_profile.get('style_preference', 'contemporary')} "
-        style_query += f"{user_profile.get('personality', 'versatile')} style clothing"
+        user_profile, session = get_session_profile(user_id, style_preferences, "Finding similar style items")
         
-        if user_profile.get('lifestyle'):
-            style_query += f" for {user_profile.get('lifestyle')} lifestyle"
-        
-        twin_items = search_fashion_items_in_qdrant(style_query, limit=6, user_profile=user_profile)
+        if session is not None and session.profile_vector is not None:
+            # The stored profile vector already is the twin query
+            hits = search_catalog(session.profile_vector, limit=6, exclude_ids=client_manager.sessions.seen_ids(session.user_id))
+            twin_items = [qdrant_payload_to_fashion_item(hit) for hit in hits]
+        else:
+            twin_items = search_fashion_items_in_qdrant(profile_style_query(user_profile), limit=6, user_profile=user_profile)
+        client_manager.sessions.mark_seen(user_id, [item.id for item in twin_items])
         
         return {
             "message": "Found fashion items that match your style profile!",
@@ -493,36 +1440,41 @@ def find_fashion_twin(style_preferences: Optional[str] = None):
             "note": "These items reflect your fashion personality and preferences."
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Fashion twin search failed: {e}")
 
 
 # Replace your old search_fashion_items function with this one
 
-def search_fashion_items(query: str, style_preferences: Optional[str] = None, filters: Optional[Dict[str, Any]] = None):
+def search_fashion_items(query: str, style_preferences: Optional[str] = None, filters: Optional[Dict[str, Any]] = None, user_id: Optional[str] = None):
     try:
-        user_profile = generate_user_profile(style_preferences, f"Searching for: {query}")
+        user_profile, session = get_session_profile(user_id, style_preferences, f"Searching for: {query}")
         
-        items = search_fashion_items_in_qdrant(query, limit=12, user_profile=user_profile, filters=filters)
+        items = search_fashion_items_in_qdrant(query, limit=12, user_profile=user_profile, filters=filters, session=session)
+        client_manager.sessions.mark_seen(user_id, [item.id for item in items])
         
         return {
             "query": query,
-            "personalization": user_profile if style_preferences else None,
+            "personalization": user_profile if style_preferences or session else None,
             "items": [item.dict() for item in items],
             "total_results": len(items)
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Fashion search failed: {e}")
 
 
 @app.post("/search", summary="Search for Fashion Items with Natural Language")
 def api_search_fashion_items(request: SearchRequest):
-    return search_fashion_items(request.query, request.style_preferences, request.filters)
+    return search_fashion_items(request.query, request.style_preferences, request.filters, request.user_id)
 
-def get_choice_approval(item_description: str, user_style: Optional[str] = None):
+def get_choice_approval(item_description: str, user_style: Optional[str] = None, user_id: Optional[str] = None):
     try:
-        user_profile = generate_user_profile(user_style, f"Evaluating: {item_description}")
+        user_profile, _ = get_session_profile(user_id, user_style, f"Evaluating: {item_description}")
         
         if not client_manager.is_gemini_configured():
             return {
@@ -556,12 +1508,10 @@ def get_choice_approval(item_description: str, user_style: Optional[str] = None)
         Return only valid JSON.
         """
         
-        model = genai.GenerativeModel('gemini-1.5-flash')
-        response = model.generate_content(prompt)
-        
         try:
-            ai_analysis = json.loads(response.text)
-        except:
+            ai_analysis = client_manager.llm.generate_json(prompt, "choice_approval")
+        except Exception as e:
+            print(f"Approval JSON generation failed: {e}")
             ai_analysis = {
                 "affinity_score": 0.7,
                 "approval": "Good Choice!",
@@ -611,14 +1561,8 @@ def api_get_actionable_suggestions(preferences: UserPreferencesRequest = None):
         if not style_prefs:
             print("No preferences provided, using fallback suggestions")
             try:
-                qdrant_client = client_manager.get_qdrant_client()
                 query_vector = get_gemini_embedding("versatile casual fashion items")
-                hits = qdrant_client.search(
-                    collection_name=QDRANT_COLLECTION_NAME,
-                    query_vector=query_vector,
-                    limit=8,
-                    with_payload=True
-                )
+                hits = search_catalog(query_vector, limit=8)
                 
                 items = []
                 for hit in hits:
@@ -634,6 +1578,8 @@ def api_get_actionable_suggestions(preferences: UserPreferencesRequest = None):
                     "message": "Here are some versatile fashion suggestions:",
                     "items": items
                 }
+            except HTTPException:
+                raise
             except Exception as e:
                 print(f"Fallback suggestion failed: {e}")
                 raise HTTPException(status_code=500, detail=f"Failed to get fallback suggestions: {str(e)}")
@@ -642,6 +1588,8 @@ def api_get_actionable_suggestions(preferences: UserPreferencesRequest = None):
         print("Successfully generated suggestions")
         return result
         
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error in api_get_actionable_suggestions: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to get suggestions: {str(e)}")
@@ -654,11 +1602,12 @@ def api_get_mixed_culture_recommendations(request: CultureRequest):
 @app.post("/find-twin", summary="Find Fashion Items Matching Your Style")
 def api_find_fashion_twin(preferences: UserPreferencesRequest = None):
     style_prefs = preferences.preferences if preferences else None
-    return find_fashion_twin(style_prefs)
+    user_id = preferences.user_id if preferences else None
+    return find_fashion_twin(style_prefs, user_id)
 
 @app.post("/search", summary="Search for Fashion Items with Natural Language")
 def api_search_fashion_items(request: SearchRequest):
-    return search_fashion_items(request.query, request.style_preferences)
+    return search_fashion_items(request.query, request.style_preferences, request.filters, request.user_id)
 
 @app.get("/search/{query}", summary="Search for Fashion Items (GET)")
 def api_search_fashion_items_get(query: str):
@@ -666,7 +1615,7 @@ def api_search_fashion_items_get(query: str):
 
 @app.post("/choice-approval", summary="Get AI Fashion Approval Rating")
 def api_get_choice_approval(request: ChoiceApprovalRequest):
-    return get_choice_approval(request.item_description, request.user_style)
+    return get_choice_approval(request.item_description, request.user_style, request.user_id)
 
 @app.get("/browse-items", summary="Browse Random Fashion Items")
 def api_browse_items(limit: int = 20):
@@ -703,17 +1652,10 @@ def api_browse_items(limit: int = 20):
 @app.get("/items/by-color/{color}", summary="Get Items by Color")
 def api_get_items_by_color(color: str, limit: int = 15):
     try:
-        qdrant_client = client_manager.get_qdrant_client()
-        
-        query = f"{color} colored clothing fashion"
+        query = color_query(color)
         query_vector = get_gemini_embedding(query)
         
-        hits = qdrant_client.search(
-            collection_name=QDRANT_COLLECTION_NAME,
-            query_vector=query_vector,
-            limit=limit,
-            with_payload=True
-        )
+        hits = search_catalog(query_vector, limit)
         
         items = []
         for hit in hits:
@@ -733,15 +1675,53 @@ def api_get_items_by_color(color: str, limit: int = 15):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Color search failed: {e}")
 
+@app.get("/ready", summary="Readiness Check")
+def readiness_check():
+    if not client_manager.ready:
+        raise HTTPException(status_code=503, detail="Warm-up in progress")
+    return {
+        "status": "ready",
+        "startup_timings": client_manager.startup_timings,
+        "warmup_errors": client_manager.warmup_errors
+    }
+
+@app.get("/metrics", summary="Upstream Budget and LLM Metrics")
+def metrics():
+    return {
+        "upstream": client_manager.admission.snapshot(),
+        "llm": client_manager.llm.stats,
+        "catalog": client_manager.catalog_sync.snapshot(),
+        "search_cache": {"entries": len(client_manager.search_cache.entries), **client_manager.search_cache.stats},
+        "sessions": client_manager.sessions.snapshot()
+    }
+
+@app.post("/catalog/sync", summary="Pull Catalog Changes from Qdrant")
+def api_sync_catalog():
+    try:
+        return client_manager.catalog_sync.sync()
+    except Exception as e:
+        raise HTTPException(status_code=502, detail=f"Catalog sync failed: {e}")
+
 @app.get("/health", summary="Detailed Health Check")
 def health_check():
+    import requests
+
     health_status = {
         "status": "healthy",
         "services": {
             "qdrant": "unknown",
             "gemini": "unknown",
             "qloo": "unknown"
-        }
+        },
+        "startup": {
+            "ready": client_manager.ready,
+            "timings": client_manager.startup_timings,
+            "warmup_errors": client_manager.warmup_errors,
+            "cached_embeddings": len(client_manager.embedding_cache),
+            "embedding_cache_bytes": client_manager.embedding_cache_nbytes(),
+            "catalog_items": len(client_manager.catalog)
+        },
+        "llm": client_manager.llm.stats
     }
     
     try:
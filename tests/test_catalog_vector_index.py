@@ -0,0 +1,41 @@
+import numpy as np
+
+from app import CatalogVectorIndex
+
+
+def test_upsert_into_empty_index_then_search():
+    index = CatalogVectorIndex()
+    index.build({})
+
+    rng = np.random.default_rng(0)
+    first = rng.standard_normal(512).astype(np.float32)
+    second = rng.standard_normal(512).astype(np.float32)
+    index.upsert("a", first)
+    index.upsert("b", second)
+
+    assert len(index) == 2
+    hits = index.search(first, limit=2)
+    assert [point_id for point_id, _ in hits] == ["a", "b"]
+    assert abs(hits[0][1] - 1.0) < 1e-5
+
+
+def test_search_matches_exact_cosine_ranking():
+    rng = np.random.default_rng(1)
+    vectors = {str(i): rng.standard_normal(512).astype(np.float32) for i in range(200)}
+    index = CatalogVectorIndex()
+    index.build(vectors)
+
+    query = rng.standard_normal(512).astype(np.float32)
+    expected = sorted(
+        vectors,
+        key=lambda point_id: -float(np.dot(vectors[point_id], query) / np.linalg.norm(vectors[point_id]))
+    )[:10]
+    assert [point_id for point_id, _ in index.search(query, limit=10)] == expected
+
+
+def test_search_skips_excluded_rows():
+    index = CatalogVectorIndex()
+    index.build({"a": np.ones(4, dtype=np.float32), "b": -np.ones(4, dtype=np.float32)})
+
+    hits = index.search(np.ones(4, dtype=np.float32), limit=2, include=lambda point_id: point_id != "a")
+    assert [point_id for point_id, _ in hits] == ["b"]